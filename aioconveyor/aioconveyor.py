@@ -15,7 +15,6 @@ from time import time
 from typing import (  # noqa: TYP001
     Any,
     AsyncGenerator,
-    Awaitable,
     Callable,
     Coroutine,
     Sequence,
@@ -32,8 +31,9 @@ class Event:
     loop_counter: int
 
 
-TProducer = Callable[[Event], Coroutine[Any, Any, str]]
-TConsumer = Callable[[Event, str], Coroutine[Any, Any, int]]
+# payload is whatever the producer returns, eg a str or a Dict of api data
+TProducer = Callable[[Event], Coroutine[Any, Any, Any]]
+TConsumer = Callable[[Event, Any], Coroutine[Any, Any, int]]
 
 
 class AioConveyor:
@@ -44,7 +44,7 @@ class AioConveyor:
 
     def __init__(
         self,
-        produce: Awaitable,
+        produce: TProducer,
         consumers: Sequence[TConsumer],
         loop_interval: float,
         loop_offset: float = 0,
@@ -138,7 +138,13 @@ class AioConveyor:
                 asyncio.create_task(c(event=event, payload=payload))
                 for c in self.consumers
             ]
-            results = await asyncio.gather(*cons_tasks)
+            # let every consumer finish before acting on a failure
+            results = await asyncio.gather(*cons_tasks, return_exceptions=True)
+            errors = [r for r in results if isinstance(r, BaseException)]
+            for ex in errors:
+                log.error(f"scheduler: consumer failed with: {ex!r}")
+            if errors:
+                raise errors[0]
             log.info(f"scheduler: consumers completed with: {results}")
             loop_counter += 1
 
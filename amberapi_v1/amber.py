@@ -6,14 +6,15 @@ import logging
 import site
 import sys
 from argparse import ArgumentParser, Namespace
-from functools import partial
+from functools import lru_cache, partial
 from getpass import getpass, getuser
 from pathlib import Path
-from typing import Any, Dict, Optional, Sequence
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 import asyncio_mqtt as mq
 import asyncpg as apg
 import keyring
+import numpy as np
 import pandas as pd
 import requests
 
@@ -36,6 +37,28 @@ LOOP_INTERVAL = 300
 LOOP_OFFSET = 150
 CONFIG_FILENAME = "amber.ini"
 NEM_TZ = "Australia/Brisbane"
+# columns delivered as strings by the API
+NUMERIC_COLS = (
+    "semiScheduledGeneration",
+    "operationalDemand",
+    "rooftopSolar",
+    "wholesaleKWHPrice",
+    "renewablesPercentage",
+    "percentileRank",
+    "usage",
+)
+DATETIME_COLS = ("createdAt", "period", "forecastedAt")
+# low cardinality string columns
+CATEGORY_COLS = ("region", "periodSource", "periodType", "postcode")
+# API record keys used by the table specs, the rest are dropped on construction.
+# periodType is not stored but selects rows for each table.
+CALCULATED_COLS = {"usage_price", "export_price", "postcode", "forecast_lead"}
+KNOWN_KEYS = frozenset(
+    {f.in_name for spec in ad.table_specs for f in spec.field_map}
+    - CALCULATED_COLS
+    - {ad.TIME_FIELD}
+    | {"periodType"},
+)
 
 
 current_row = int
@@ -57,45 +80,64 @@ def to_timeseries(data: Dict[str, Any], rounding: Optional[int] = 3) -> pd.DataF
     # currentNEMtime = data["currentNEMtime"]  # brisbane tz
     # networkProvider = data["networkProvider"]
     # E2 = staticPrices["E2"]
-    timeseries = pd.DataFrame(data["variablePricesAndRenewables"])
-    timeseries.drop(columns=["forecastedAt+period"], inplace=True)
+    timeseries = pd.DataFrame(
+        [
+            {k: v for k, v in r.items() if k in KNOWN_KEYS}
+            for r in data["variablePricesAndRenewables"]
+        ],
+    )
     log.info(f"length of timeseries: {len(timeseries)}")
-    for col in [
-        "semiScheduledGeneration",
-        "operationalDemand",
-        "rooftopSolar",
-        "wholesaleKWHPrice",
-        "renewablesPercentage",
-        "percentileRank",
-        "usage",
-    ]:
-        try:
-            timeseries[col] = timeseries[col].astype(float)
-        except KeyError:
-            log.warning(
-                f"column '{col}' not found when trying to convert to float."
-                "Column will be missing for insert",
-            )
-            # timeseries[col] = None
+    present = timeseries.columns.intersection(NUMERIC_COLS)
+    missing = set(NUMERIC_COLS) - set(present)
+    if missing:
+        log.warning(
+            f"columns {sorted(missing)} not found when trying to convert to float. "
+            "Columns will be missing for insert",
+        )
+    # to_numeric infers int64 for all integral strings, the columns are always float
+    timeseries[present] = (
+        timeseries[present].apply(pd.to_numeric, errors="coerce").astype("float64")
+    )
     timeseries["postcode"] = postcode
-    for col in ("createdAt", "period", "forecastedAt"):
-        timeseries[col] = pd.to_datetime(timeseries[col])
-        timeseries[col] = timeseries[col].dt.tz_localize(NEM_TZ)
+    for col in DATETIME_COLS:
+        if col in timeseries.columns:
+            # API times are naive NEM time, parse and localize in one assignment
+            timeseries[col] = pd.to_datetime(
+                timeseries[col],
+                errors="coerce",
+            ).dt.tz_localize(NEM_TZ)
     staticPrices = data["staticPrices"]
     E1 = staticPrices["E1"]
-    # formula from Amber
+    B1 = staticPrices["B1"]
+    # formula from Amber, on the raw array to skip intermediate Series
+    wholesale = timeseries["wholesaleKWHPrice"].to_numpy(dtype=np.float64)
     timeseries["usage_price"] = (
-        float(E1["totalfixedKWHPrice"])
-        + float(E1["lossFactor"]) * timeseries.wholesaleKWHPrice
+        np.float64(E1["totalfixedKWHPrice"]) + np.float64(E1["lossFactor"]) * wholesale
     )
-    B1 = staticPrices["B1"]
     timeseries["export_price"] = (
-        float(B1["totalfixedKWHPrice"])
-        - float(B1["lossFactor"]) * timeseries.wholesaleKWHPrice
+        np.float64(B1["totalfixedKWHPrice"]) - np.float64(B1["lossFactor"]) * wholesale
     )
+    for col in CATEGORY_COLS:
+        if col in timeseries.columns:
+            timeseries[col] = timeseries[col].astype("category")
     return timeseries.round(rounding)
 
 
+def row_to_fields_values(
+    df: pd.DataFrame,
+) -> Tuple[Tuple[str, ...], Tuple[Any, ...]]:
+    """return column names and values for the non null fields of the first row
+
+    Values are native python objects (via tolist) suitable for asyncpg and json.
+    Both are tuples so fields can key the insert SQL cache and values can be
+    bound positionally as is.
+    """
+    arr = df.to_numpy()[0]
+    keep = ~pd.isna(arr)
+    fields = tuple(c for c, k in zip(df.columns, keep) if k)
+    return fields, tuple(arr[keep].tolist())
+
+
 def get_db_args(defaults: Optional[Dict[str, str]] = None) -> ArgumentParser:
     user = getuser()
     ap = ArgumentParser(add_help=False)
@@ -151,6 +193,7 @@ def get_common_args(defaults: Optional[Dict[str, str]] = None) -> ArgumentParser
     return ap
 
 
+@lru_cache(maxsize=None)
 def find_config_file(config_filename: Path) -> Path:
     locations: Sequence[str] = [
         loc for loc in (site.USER_BASE, sys.prefix, "/etc") if loc is not None
@@ -252,7 +295,8 @@ def get_password(
 
 
 async def produce(event: Event, postcode: str) -> Dict:
-    raw_dict = fetch_data(postcode)
+    # requests is blocking, keep it off the event loop so timers stay accurate
+    raw_dict = await asyncio.to_thread(fetch_data, postcode)
     return raw_dict
 
 
@@ -283,7 +327,8 @@ class MqttConsumer:
     def __init__(self, host: str, topic_template: str) -> None:
         self.host = host
         self.topic_template = topic_template
-        self.enc = DateAwareJSONEncoder()
+        # payloads are flat dicts so skip the circular reference bookkeeping
+        self.enc = DateAwareJSONEncoder(check_circular=False)
 
     async def start_client(self) -> mq.Client:
         self.client = mq.Client(self.host)
@@ -302,9 +347,14 @@ class MqttConsumer:
         data = payload["data"]
         ts = to_timeseries(data)
         ts[ad.TIME_FIELD] = event.event_time
+        masks = ad.build_masks(ts)
 
         for spec in ad.table_specs:
-            df = spec.do_calculate(ts)
+            try:
+                df = spec.do_calculate(ts, masks)
+            except Exception:
+                log.exception("mqtt calculation exception: %s", spec.table_name)
+                continue
             if df is None or df.empty:
                 log.info("mqtt table: %s is empty", spec.table_name)
                 continue
@@ -313,8 +363,8 @@ class MqttConsumer:
                 continue
 
             try:
-                d = df.squeeze().dropna().to_dict()
-                msg = self.enc.encode(d)
+                fields, values = row_to_fields_values(df)
+                msg = self.enc.encode(dict(zip(fields, values)))
                 await self.client.publish(
                     self.topic_template.format(series=spec.table_name),
                     msg,
@@ -332,12 +382,16 @@ class PostgresConsumer:
         database: str,
         user: str,
         password: str,
+        min_size: int = 2,
+        max_size: int = 4,
     ):
         self.host = host
         self.database = database
         self.user = user
         self.password = password
-        self.conn: apg.Connection
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool: apg.Pool
 
     async def connect(self):
         if self.password is None:
@@ -346,78 +400,93 @@ class PostgresConsumer:
             raise Exception("database host must not be None")
         user = getuser() if self.user is None else self.user
         log.info(f"user: {user} db: {self.database} host: {self.host}")
-        self.conn = await apg.connect(
+        self.pool = await apg.create_pool(
             user=self.user,
             database=self.database,
             host=self.host,
             password=self.password,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            command_timeout=10,
         )
 
     async def create_tables(self):
-        for spec in ad.table_specs:
-            create_sql = dc.compose_create(
-                table_name=spec.table_name,
-                fields=spec.field_map,
-                primary_key=spec.primary_key,
-                extra_sql=spec.extra_sql,
-            )
-            try:
-                log.debug("create table: %s with \n %s", spec.table_name, create_sql)
-                await self.conn.execute(create_sql)
-            except Exception:
-                log.exception("failed to create table: %s", create_sql)
-
-    async def write(self, event: Event, payload: Dict) -> int:
-        if event.loop_counter < 1:
-            try:
-                await self.connect()
-                await self.create_tables()
-            except Exception:
-                log.exception("PostgresWriter: failed to initialize connection/tables")
-                raise
+        async with self.pool.acquire() as conn:
+            for spec in ad.table_specs:
+                create_sql = spec.create_sql
+                try:
+                    log.debug(
+                        "create table: %s with \n %s",
+                        spec.table_name,
+                        create_sql,
+                    )
+                    await conn.execute(create_sql)
+                except Exception:
+                    log.exception("failed to create table: %s", create_sql)
 
-        # create raw dataframe
-        data = payload["data"]
-        ts = to_timeseries(data)
-        ts[ad.TIME_FIELD] = event.event_time
+    async def _copy_batch(
+        self,
+        conn: apg.Connection,
+        spec: dc.TableSpec,
+        df: pd.DataFrame,
+    ) -> None:
+        """write multiple rows in one round trip using binary COPY
+
+        Rows are built column wise, applying any FieldMap.convert.
+        """
+        fields = [f for f in spec._kept_fields if f.in_name in df.columns]
+        # asyncpg quotes COPY columns, so use the lower case names the DDL created
+        columns = [dc.folded_column_name(f._eff_col) for f in fields]
+        batch = dc.ColumnarBatch({f.in_name: df[f.in_name].to_numpy() for f in fields})
+        log.debug("postgres %s fields: %s", spec.table_name, columns)
+        await conn.copy_records_to_table(
+            spec.table_name,
+            records=dc.to_rows(batch, fields),
+            columns=columns,
+        )
 
+    async def insert_one(
+        self,
+        spec: dc.TableSpec,
+        ts: pd.DataFrame,
+        masks: Dict,
+    ) -> None:
+        """calculate and insert the rows for one table"""
         try:
-            for spec in ad.table_specs:
-                df = spec.do_calculate(ts)
-                if df is None or df.empty:
-                    log.info("table: %s is empty", spec.table_name)
-                    continue
-                print(spec.table_name)
-                print(df.head())
-                log.info("postgres: table: %s len: %d", spec.table_name, len(df))
+            df = spec.do_calculate(ts, masks)
+        except Exception:
+            log.exception("calculation exception: %s", spec.table_name)
+            return
+        if df is None or df.empty:
+            log.info("table: %s is empty", spec.table_name)
+            return
+        if len(df) > 1 and spec.primary_key:
+            # hypertables ingest fastest in time order, the time column leads the key
+            df = df.sort_values(spec.primary_key.split(",")[0].strip())
+        log.debug("postgres: table: %s head:\n%s", spec.table_name, df.head())
+        log.info("postgres: table: %s len: %d", spec.table_name, len(df))
 
+        try:
+            async with self.pool.acquire() as conn:
                 if len(df) > 1:
                     log.info("table: %s has %d rows", spec.table_name, len(df))
-                    args = df.to_dict("records")
-                    print("args")
-                    print(args[:3])
-                    fields = list(args[0].keys())
-                    log.debug("postgres %s fields: %s", spec.table_name, fields)
-                    ins_sql = dc.compose_insert(fields, table_name=spec.table_name)
                     try:
-                        await self.conn.executemany(
-                            ins_sql,
-                            [list(d.values()) for d in args],
-                        )
+                        await self._copy_batch(conn, spec, df)
                     except apg.exceptions.UniqueViolationError:
                         # this can happen during testing if writing in < 5 min
                         log.warning(
                             "unique violation - could be a restart so continuing",
                         )
-                    continue
+                    return
 
+                fields, values = row_to_fields_values(df)
                 try:
-                    data = df.dropna().squeeze().to_dict()
-                    # cull fields we are not storing
-                    fields = list(data.keys())
+                    # null fields are culled, the column default applies
                     log.debug("postgres %s fields: %s", spec.table_name, fields)
+                    # compose_insert is cached and each pooled connection's
+                    # statement cache holds the prepared plan
                     ins_sql = dc.compose_insert(fields, table_name=spec.table_name)
-                    await self.conn.execute(ins_sql, *data.values())
+                    await conn.execute(ins_sql, *values)
                 except apg.exceptions.UniqueViolationError:
                     # this can happen during testing if writing in < 5 min
                     log.warning(
@@ -427,19 +496,37 @@ class PostgresConsumer:
                     log.exception(
                         "postgres failed to write %s: %s with %s",
                         spec.table_name,
-                        ins_sql,
-                        data.values(),
+                        fields,
+                        values,
                     )
-                log.info("PostgresWriter: %s written", spec.table_name)
-            return 0
+            log.info("PostgresWriter: %s written", spec.table_name)
         except Exception:
             log.exception("PostgresWriter: failed to write: '%s'", spec.table_name)
             raise
+
+    async def write(self, event: Event, payload: Dict) -> int:
+        if event.loop_counter < 1:
+            try:
+                await self.connect()
+                await self.create_tables()
+            except Exception:
+                log.exception("PostgresWriter: failed to initialize connection/tables")
+                raise
+
+        # create raw dataframe
+        data = payload["data"]
+        ts = to_timeseries(data)
+        ts[ad.TIME_FIELD] = event.event_time
+        masks = ad.build_masks(ts)
+
+        # tables are independent so insert them concurrently on pooled connections
+        await asyncio.gather(
+            *[self.insert_one(spec, ts, masks) for spec in ad.table_specs],
+        )
         return 0
 
 
-async def amain():
-    opt = get_args()
+async def amain(opt: Namespace):
     log.setLevel(level=opt.log_level)
     # consumers = [csv_consume]
     consumers = []
@@ -474,7 +561,9 @@ async def amain():
 
 
 def main():
-    asyncio.run(amain())
+    # config, keyring and password prompt are blocking so do them before the loop
+    opt = get_args()
+    asyncio.run(amain(opt))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
 import logging
-from typing import Dict, Tuple
+from typing import Dict
 
+import numpy as np
 import pandas as pd
 
 from .datacomposer import FieldMap, TableSpec, compose_create, compose_insert
@@ -110,59 +111,106 @@ forecast_rolling_fields = [
 ]
 
 
-def map_to_array(m: Dict[str, str]) -> Tuple[float, float]:
-    try:
-        t = (float(m["min"]), float(m["max"]))
-        return t
-    except Exception:
-        log.exception("json encode failed")
-        return (0, 0)
-
-
-def calculate_actual_30min(spec: TableSpec, df: pd.DataFrame) -> pd.DataFrame:
-    of = df.loc[
-        (df.periodType == "ACTUAL") & (df.periodSource == "30MIN"),
-        df.columns.intersection(spec.get_column_names()),
-    ]
-    return of.iloc[[-1]]
-
-
-def calculate_actual_5min(spec: TableSpec, df: pd.DataFrame) -> pd.DataFrame:
+def extract_price_range(s: pd.Series) -> pd.Series:
+    """convert series of {"min": str, "max": str} to (min, max) tuples"""
+    # to_numeric infers int64 for integral strings, prices are always float
+    mn = pd.to_numeric(s.str.get("min"), errors="coerce").fillna(0.0).astype("float64")
+    mx = pd.to_numeric(s.str.get("max"), errors="coerce").fillna(0.0).astype("float64")
+    return pd.Series(list(zip(mn.tolist(), mx.tolist())), index=s.index, dtype=object)
+
+
+def build_masks(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """row selections shared by the calculate functions, computed once per tick
+
+    A missing periodType or periodSource column selects no rows rather than
+    raising, so one bad payload does not stop the consumers.
+    """
+    masks = {}
+    for col, key, value in (
+        ("periodType", "actual", "ACTUAL"),
+        ("periodType", "forecast", "FORECAST"),
+        ("periodSource", "5min", "5MIN"),
+        ("periodSource", "30min", "30MIN"),
+    ):
+        if col in df.columns:
+            masks[key] = df[col].values == value
+        else:
+            log.warning(f"column {col} not found, no rows selected for {key}")
+            masks[key] = np.zeros(len(df), dtype=bool)
+    return masks
+
+
+def calculate_actual_30min(
+    spec: TableSpec,
+    df: pd.DataFrame,
+    masks: Dict[str, np.ndarray],
+) -> pd.DataFrame:
+    cols = [c for c in df.columns if c in spec._column_name_set]
+    # only the latest row is wanted so avoid copying the whole selection
+    idxs = np.flatnonzero(masks["actual"] & masks["30min"])
+    if len(idxs) == 0:
+        return df.iloc[:0][cols]
+    return df.iloc[[idxs[-1]]][cols]
+
+
+def calculate_actual_5min(
+    spec: TableSpec,
+    df: pd.DataFrame,
+    masks: Dict[str, np.ndarray],
+) -> pd.DataFrame:
     of = df.loc[
-        (df.periodType == "ACTUAL") & (df.periodSource == "5MIN"),
-        df.columns.intersection(spec.get_column_names()),
+        masks["actual"] & masks["5min"],
+        [c for c in df.columns if c in spec._column_name_set],
     ]
     # this sometimes has no rows
     return of
 
 
-def calculate_forecast(spec: TableSpec, df: pd.DataFrame) -> pd.DataFrame:
-    # table_columns = ad.table_specs[ad.TABLE_RAW_FORECAST].get_column_names()
-    of = df.loc[
-        df.periodType == "FORECAST",
-        df.columns.intersection(spec.get_column_names()),
-    ]
+def calculate_forecast(
+    spec: TableSpec,
+    df: pd.DataFrame,
+    masks: Dict[str, np.ndarray],
+) -> pd.DataFrame:
+    cols = [c for c in df.columns if c in spec._column_name_set]
+    # only the nearest forecast is wanted
+    idxs = np.flatnonzero(masks["forecast"])
+    if len(idxs) == 0:
+        return df.iloc[:0][cols]
+    of = df.iloc[[idxs[0]]][cols]
     if "wholesaleKWHPriceRange" in of.columns:
-        of["wholesaleKWHPriceRange"] = of.wholesaleKWHPriceRange.map(map_to_array)
-    return of.iloc[[0]]
+        of["wholesaleKWHPriceRange"] = extract_price_range(of.wholesaleKWHPriceRange)
+    return of
 
 
-def calculate_forecast_rolling(spec: TableSpec, df: pd.DataFrame) -> pd.DataFrame:
+def calculate_forecast_rolling(
+    spec: TableSpec,
+    df: pd.DataFrame,
+    masks: Dict[str, np.ndarray],
+) -> pd.DataFrame:
     of = df.loc[
-        df.periodType == "FORECAST",
-        df.columns.intersection(spec.get_column_names()),
+        masks["forecast"],
+        [c for c in df.columns if c in spec._column_name_set],
     ]
-    of["forecast_lead"] = (of.period - of.forecastedAt).dt.seconds
+    extra = {}
     if "wholesaleKWHPriceRange" in of.columns:
-        of["wholesaleKWHPriceRange"] = of.wholesaleKWHPriceRange.map(map_to_array)
-    return of
+        extra["wholesaleKWHPriceRange"] = extract_price_range(of.wholesaleKWHPriceRange)
+    # total_seconds, .dt.seconds wraps at one day
+    lead = (of.period - of.forecastedAt).dt.total_seconds()
+    # forecast_lead is part of the primary key, rows with unparseable times
+    # have no lead and cannot be stored
+    valid = lead.notna()
+    if not valid.all():
+        log.warning(f"dropping {(~valid).sum()} forecast rows with no forecast_lead")
+        of, lead = of[valid], lead[valid]
+        extra = {k: v[valid] for k, v in extra.items()}
+    return of.assign(forecast_lead=lead.astype("int32"), **extra)
 
 
 # https://docs.timescale.com/latest/api#create_hypertable
 
 DEFAULT_HYPERTABLE = (
     "SELECT create_hypertable('{table_name}', '{primary_key}', "
-    "if_not_exists => TRUE);"
+    "chunk_time_interval => INTERVAL '1 day', if_not_exists => TRUE);"
 )
 
 table_specs = [
@@ -202,6 +250,15 @@ table_specs = [
     ),
 ]
 
+# table_specs is static so the DDL only needs composing once
+for spec in table_specs:
+    spec.create_sql = compose_create(
+        table_name=spec.table_name,
+        fields=spec._kept_fields,
+        primary_key=spec.primary_key,
+        extra_sql=spec.extra_sql,
+    )
+
 
 if __name__ == "__main__":
 
@@ -2,20 +2,20 @@
 
 from __future__ import annotations
 
+import functools
 import logging
-from dataclasses import dataclass
-from typing import Any, Callable, Sequence
+import sys
+from dataclasses import dataclass, field
+from itertools import compress
+from operator import attrgetter
+from typing import Any, Callable, Iterator, Mapping, Sequence
 
-logging.basicConfig()
-log = logging.getLogger(__file__)
-log.setLevel(logging.INFO)
+import numpy as np
 
+log = logging.getLogger(__name__)
 
-def null_convert(input: Any) -> Any:
-    return input
 
-
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FieldMap:
     """meta data for sql"""
 
@@ -23,84 +23,275 @@ class FieldMap:
     data_type: str | None = "VARCHAR"
     column_name: str | None = None
     primary_key: bool | None = False
-    keep: bool | None = True
+    keep: bool = True
     default: str | None = None
-    convert: Callable[[Any], Any] | None = null_convert
+    # None means values are used as is, test for it rather than calling
+    convert: Callable[[Any], Any] | None = None
     comment: str | None = None
+    # column_name or in_name, derived in __post_init__
+    _eff_col: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # identifiers are hashed and compared a lot, share one copy of each
+        object.__setattr__(self, "in_name", sys.intern(self.in_name))
+        if self.column_name is not None:
+            object.__setattr__(self, "column_name", sys.intern(self.column_name))
+        if self.data_type is not None:
+            object.__setattr__(self, "data_type", sys.intern(self.data_type))
+        object.__setattr__(self, "_eff_col", self.column_name or self.in_name)
+
+
+_keep = attrgetter("keep")
 
 
-def get_in_names(fm: Sequence[FieldMap]) -> Sequence[str]:
+def kept(fm: Sequence[FieldMap]) -> Iterator[FieldMap]:
+    """iterate fields with keep set, filtered in C"""
+    return compress(fm, map(_keep, fm))
+
+
+def get_in_names(fm: Sequence[FieldMap]) -> tuple[str, ...]:
     """return names in incoming data"""
-    return [f.in_name for f in fm if f.keep]
+    return tuple(f.in_name for f in kept(fm))
 
 
-def get_column_names(fm: Sequence[FieldMap]) -> Sequence[str]:
+def get_column_names(fm: Sequence[FieldMap]) -> tuple[str, ...]:
     """return column names in incoming data"""
-    return [f.column_name if f.column_name else f.in_name for f in fm if f.keep]
+    return tuple(f._eff_col for f in kept(fm))
+
+
+def folded_column_name(name: str) -> str:
+    """column name as postgres stores it, compose_create does not quote names"""
+    return name.lower()
+
+
+def numeric_convert(sig: str = "float64(float64)") -> Callable:
+    """decorator compiling a scalar numeric convert into a numpy ufunc with numba
+
+    to_rows applies a ufunc convert to a whole ndarray column in one call.
+    Without numba installed the function is returned unchanged.
+
+    Args:
+        sig (str): numba signature of the scalar function.
+    """
+
+    def deco(f: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        # imported here so importing this module does not pay for numba
+        try:
+            from numba import vectorize
+        except ImportError:  # numba is optional, converts then run as plain python
+            return f
+        try:
+            compiled = vectorize([sig], cache=True)(f)
+        except RuntimeError:
+            # no source file to cache against, eg defined in exec or a REPL
+            compiled = vectorize([sig])(f)
+        # newer numba returns a DUFunc wrapping the real ufunc
+        return getattr(compiled, "ufunc", compiled)
+
+    return deco
+
+
+@dataclass(slots=True)
+class ColumnarBatch:
+    """struct of arrays batch, one sequence (list or ndarray) per in_name"""
+
+    data: dict[str, Sequence[Any]]
+
+    @classmethod
+    def from_struct(cls, rows_struct: np.ndarray) -> ColumnarBatch:
+        """view each field of a structured array as a column"""
+        return cls({name: rows_struct[name] for name in rows_struct.dtype.names})
+
+
+def to_rows(cb: ColumnarBatch, fm: Sequence[FieldMap]) -> list[tuple]:
+    """convert a columnar batch to insert parameter tuples
+
+    Works column by column: identity columns are a single C level tolist(),
+    only fields with a convert callable are mapped in python. Rows are then
+    assembled by zip.
+
+    Args:
+        cb (ColumnarBatch): columns keyed by in_name.
+        fm (Sequence[FieldMap]): fields to extract, only kept fields are used.
 
+    Returns:
+        list[tuple]: one tuple per row in kept field order.
+    """
+    cols = []
+    for f in kept(fm):
+        col = cb.data[f.in_name]
+        if isinstance(col, np.ndarray):
+            if col.dtype.kind in "mM":
+                # tolist() of datetime64[ns]/timedelta64[ns] gives integer ns,
+                # at us (postgres precision) it gives datetime/timedelta
+                col = col.astype(f"{col.dtype.str[1:3]}[us]").astype(object)
+            if f.convert is None:
+                cols.append(col.tolist())
+            elif isinstance(f.convert, np.ufunc):
+                # compiled numeric convert, whole column in one call
+                cols.append(f.convert(col).tolist())
+            else:
+                # python convert, numpy drives the loop
+                cols.append(np.frompyfunc(f.convert, 1, 1)(col).tolist())
+        else:
+            cols.append(col if f.convert is None else [f.convert(v) for v in col])
+    return list(zip(*cols))
+
+
+def compose_values_rows(
+    rows_struct: np.ndarray,
+    fm: Sequence[FieldMap],
+) -> list[tuple]:
+    """convert a structured array, eg DataFrame.to_records(), to parameter tuples"""
+    return to_rows(ColumnarBatch.from_struct(rows_struct), fm)
 
-@dataclass
+
+@dataclass(slots=True)
 class TableSpec:
     field_map: Sequence[FieldMap]
     table_name: str
     primary_key: str | None = None
-    calculate: Callable[[TableSpec, Any], Any] | None = None
-    extra_sql: list[str] | None = None
+    calculate: Callable[[TableSpec, Any, Any], Any] | None = None
+    extra_sql: Sequence[str] | None = None
+    create_sql: str | None = None
+    # derived in __post_init__
+    _kept_fields: tuple[FieldMap, ...] = field(init=False, repr=False, compare=False)
+    _in_names: tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _column_names: tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _column_name_set: frozenset[str] = field(init=False, repr=False, compare=False)
+    # positions in _kept_fields passed through as is / run through their convert
+    _identity_idx: tuple[int, ...] = field(init=False, repr=False, compare=False)
+    _convert_pairs: tuple[tuple[int, Callable], ...] = field(
+        init=False,
+        repr=False,
+        compare=False,
+    )
+    _row_encoder: Callable[[Mapping[str, Any]], tuple] | None = field(
+        default=None,
+        init=False,
+        repr=False,
+        compare=False,
+    )
 
-    def do_calculate(self, timeseries: Any) -> Any:
-        if self.calculate:
-            try:
-                return self.calculate(self, timeseries)
-            except Exception:
-                log.exception("calculation exception: %s", self.table_name)
-                # log.error("calculate: %s", timeseries)
+    def __post_init__(self):
+        # freeze the sequences so the derived values below cannot go stale
+        self.field_map = tuple(self.field_map)
+        if self.extra_sql is not None:
+            self.extra_sql = tuple(self.extra_sql)
+        self.table_name = sys.intern(self.table_name)
+        self._kept_fields = tuple(kept(self.field_map))
+        self._in_names = get_in_names(self._kept_fields)
+        self._column_names = get_column_names(self._kept_fields)
+        self._column_name_set = frozenset(self._column_names)
+        self._identity_idx = tuple(
+            i for i, f in enumerate(self._kept_fields) if f.convert is None
+        )
+        self._convert_pairs = tuple(
+            (i, f.convert)
+            for i, f in enumerate(self._kept_fields)
+            if f.convert is not None
+        )
 
-    def get_in_names(self):
-        return get_in_names(self.field_map)
+    def do_calculate(self, timeseries: Any, masks: Any = None) -> Any:
+        """run calculate, exceptions propagate to the caller"""
+        return self.calculate(self, timeseries, masks) if self.calculate else None
 
-    def get_column_names(self):
-        return get_column_names(self.field_map)
+    def get_in_names(self) -> tuple[str, ...]:
+        return self._in_names
+
+    def get_column_names(self) -> tuple[str, ...]:
+        return self._column_names
+
+    def build_row_encoder(self) -> Callable[[Mapping[str, Any]], tuple]:
+        """return a function mapping a record to its insert parameter tuple
+
+        The function is generated once per spec with the field lookups and
+        converts inlined, eg `lambda r: (r["a"], conv_1(r["b"]))`, so there is
+        no loop over field_map per row.
+        """
+        if self._row_encoder is None:
+            names = self._in_names
+            ns: dict[str, Any] = {}
+            exprs = [""] * len(names)
+            for i in self._identity_idx:
+                exprs[i] = f"r[{names[i]!r}]"
+            for i, conv in self._convert_pairs:
+                ns[f"conv_{i}"] = conv
+                exprs[i] = f"conv_{i}(r[{names[i]!r}])"
+            # trailing comma per item so one field is a tuple and none is ()
+            items = "".join(f"{e}, " for e in exprs)
+            src = f"def _enc(r):\n    return ({items})\n"
+            exec(src, ns)
+            self._row_encoder = ns["_enc"]
+        return self._row_encoder
 
 
 def compose_create(
     table_name: str,
-    fields: list[FieldMap],
+    fields: Sequence[FieldMap],
     primary_key: str | None = None,
-    extra_sql: list[str] | None = None,
+    extra_sql: Sequence[str] | None = None,
+) -> str:
+    """compose create table SQL, cached on the (frozen, hashable) fields"""
+    return _compose_create_cached(
+        table_name,
+        tuple(fields),
+        primary_key,
+        tuple(extra_sql) if extra_sql else None,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _compose_create_cached(
+    table_name: str,
+    fields: tuple[FieldMap, ...],
+    primary_key: str | None = None,
+    extra_sql: Sequence[str] | None = None,
 ) -> str:
-    clauses = []
     fdesc = ",\n".join(
-        [
-            f"{f.column_name if f.column_name else f.in_name} {f.data_type} "
-            f"{f.default if f.default is not None else ''}".strip()
-            for f in fields
-            if f.keep
-        ],
+        f"{f._eff_col} {f.data_type}"
+        + (f" {f.default}" if f.default is not None else "")
+        for f in kept(fields)
     )
-    clauses.append(f"CREATE TABLE IF NOT EXISTS {table_name} (\n{fdesc}")
-    if primary_key:
-        clauses.append(f", PRIMARY KEY({primary_key})")
-    clauses.append(");")
+    pk = f"\n, PRIMARY KEY({primary_key})" if primary_key else ""
+    sql = f"CREATE TABLE IF NOT EXISTS {table_name} (\n{fdesc}{pk}\n);"
     if extra_sql:
-        try:
-            for xsql in extra_sql:
-                clauses.append(
-                    xsql.format(table_name=table_name, primary_key=primary_key),
-                )
-        except Exception:
-            print("xsql %s table_name %s primary_key %s", xsql, table_name, primary_key)
-            raise
-    sql = "\n".join(clauses)
+        sql += "\n" + "\n".join(
+            _render_extra_sql(xsql, table_name, primary_key) for xsql in extra_sql
+        )
     return sql
 
 
+@functools.lru_cache(maxsize=256)
+def _render_extra_sql(xsql: str, table_name: str, primary_key: str | None) -> str:
+    """render one extra_sql template, cached per (template, table, key)"""
+    try:
+        return xsql.format(table_name=table_name, primary_key=primary_key)
+    except Exception:
+        log.exception(
+            "xsql %r table_name %s primary_key %s",
+            xsql,
+            table_name,
+            primary_key,
+        )
+        raise
+
+
+@functools.lru_cache(maxsize=256)
+def _placeholders(n: int) -> str:
+    """return positional placeholders "$1, $2, ..., $n" """
+    return ", ".join(f"${i}" for i in range(1, n + 1))
+
+
 def compose_insert(
-    field_names: Sequence,
+    field_names: Sequence[str],
     table_name: str,
     xclause: str | None = None,
 ) -> str:
     """compose parameterized insert SQL
 
+    Results are cached so repeat calls for the same fields are a dict lookup.
+
     Args:
         field_names (Sequence): database table field names
         table_name (str): database table name.
@@ -108,8 +299,17 @@ def compose_insert(
     Returns:
         str: insert SQL.
     """
+    return _compose_insert_cached(tuple(field_names), table_name, xclause)
+
+
+@functools.lru_cache(maxsize=None)
+def _compose_insert_cached(
+    field_names: tuple[str, ...],
+    table_name: str,
+    xclause: str | None = None,
+) -> str:
     fields = ", ".join(field_names)
-    placeholders = ", ".join([f"${i+1}" for i in range(len(field_names))])
+    placeholders = _placeholders(len(field_names))
     sql = f"INSERT INTO {table_name} ({fields}) values ({placeholders})"
     if xclause:
         sql = f"{sql}\n{xclause}"
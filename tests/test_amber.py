@@ -0,0 +1,58 @@
+import asyncio
+
+import pandas as pd
+
+from amberapi_v1 import amber
+from amberapi_v1 import amber_data as ad
+
+
+class FakeConn:
+    def __init__(self):
+        self.copies = []
+
+    async def copy_records_to_table(self, table_name, records, columns):
+        self.copies.append((table_name, list(columns), list(records)))
+
+
+def ddl_columns(create_sql):
+    """column identifiers from compose_create output as postgres folds them"""
+    body = create_sql.split("(\n", 1)[1].split("\n);", 1)[0]
+    body = body.split("\n, PRIMARY KEY", 1)[0]
+    return [line.split()[0].lower() for line in body.split(",\n")]
+
+
+def test_copy_columns_match_ddl():
+    pg = amber.PostgresConsumer(host="h", database="d", user="u", password="p")
+    for spec in ad.table_specs:
+        df = pd.DataFrame({name: [None, None] for name in spec.get_in_names()})
+        conn = FakeConn()
+        asyncio.run(pg._copy_batch(conn, spec, df))
+        [(table_name, columns, records)] = conn.copies
+        assert table_name == spec.table_name
+        assert columns == ddl_columns(spec.create_sql)
+        assert len(records) == 2
+
+
+def test_to_timeseries_integral_values_are_float():
+    row = {
+        "periodType": "ACTUAL",
+        "periodSource": "30MIN",
+        "period": "2022-06-01T10:00:00",
+        "operationalDemand": "6003",
+        "rooftopSolar": "300",
+        "wholesaleKWHPrice": "1",
+        "renewablesPercentage": "0",
+        "percentileRank": "1",
+    }
+    data = {
+        "postcode": "3000",
+        "variablePricesAndRenewables": [row, row],
+        "staticPrices": {
+            "E1": {"totalfixedKWHPrice": "0.2", "lossFactor": "1.05"},
+            "B1": {"totalfixedKWHPrice": "0.01", "lossFactor": "1.02"},
+        },
+    }
+    ts = amber.to_timeseries(data)
+    for col in ts.columns.intersection(amber.NUMERIC_COLS):
+        assert ts[col].dtype == "float64", col
+    assert ts.operationalDemand.tolist() == [6003.0, 6003.0]
@@ -0,0 +1,53 @@
+import pandas as pd
+
+from amberapi_v1 import amber_data as ad
+
+
+def test_extract_price_range_is_float():
+    s = pd.Series([{"min": "1", "max": "2"}, {"min": "1.5", "max": None}])
+    ranges = ad.extract_price_range(s).tolist()
+    assert ranges == [(1.0, 2.0), (1.5, 0.0)]
+    assert all(type(v) is float for r in ranges for v in r)
+
+
+def spec_for(table_name):
+    return next(s for s in ad.table_specs if s.table_name == table_name)
+
+
+def nem(times):
+    return pd.to_datetime(times).tz_localize("Australia/Brisbane")
+
+
+def forecast_frame(forecasted_at):
+    return pd.DataFrame(
+        {
+            "periodType": "FORECAST",
+            "periodSource": "30MIN",
+            "period": nem(["2022-06-01 10:30", "2022-06-02 10:30", "2022-06-01 11:00"]),
+            "forecastedAt": nem(forecasted_at),
+            "wholesaleKWHPrice": [0.1, 0.2, 0.3],
+        },
+    )
+
+
+def test_forecast_rolling_lead_and_nat():
+    df = forecast_frame(["2022-06-01 10:00", "2022-06-01 10:00", None])
+    spec = spec_for(ad.TABLE_RAW_FORECAST_ROLLING)
+    of = ad.calculate_forecast_rolling(spec, df, ad.build_masks(df))
+    # the NaT forecastedAt row has no lead and is dropped, leads over a day
+    # are not wrapped
+    assert of.forecast_lead.tolist() == [1800, 88200]
+    assert of.wholesaleKWHPrice.tolist() == [0.1, 0.2]
+
+
+def test_build_masks_missing_columns():
+    df = forecast_frame(["2022-06-01 10:00"] * 3)
+    for col, keys in (
+        ("periodType", ("actual", "forecast")),
+        ("periodSource", ("5min", "30min")),
+    ):
+        masks = ad.build_masks(df.drop(columns=col))
+        assert set(masks) == {"actual", "forecast", "5min", "30min"}
+        for key in keys:
+            assert masks[key].dtype == bool
+            assert masks[key].tolist() == [False] * len(df)
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import pandas as pd
+
+from amberapi_v1.datacomposer import FieldMap, TableSpec, compose_values_rows
+
+
+def test_row_encoder_kept_fields_and_converts():
+    spec = TableSpec(
+        [
+            FieldMap("a"),
+            FieldMap("b", convert=float),
+            FieldMap("c", keep=False),
+            FieldMap("it's"),
+        ],
+        "t",
+    )
+    enc = spec.build_row_encoder()
+    assert enc({"a": 1, "b": "2.5", "c": 3, "it's": 4}) == (1, 2.5, 4)
+    assert spec.build_row_encoder() is enc
+
+
+def test_row_encoder_single_field():
+    enc = TableSpec([FieldMap("a")], "t").build_row_encoder()
+    assert enc({"a": 1}) == (1,)
+
+
+def test_row_encoder_no_kept_fields():
+    enc = TableSpec([FieldMap("a", keep=False)], "t").build_row_encoder()
+    assert enc({"a": 1}) == ()
+
+
+def test_values_rows_datetime64_column():
+    df = pd.DataFrame({"t": pd.to_datetime(["2022-01-01 10:30", None]), "x": [1, 2]})
+    rows = compose_values_rows(df.to_records(index=False), [FieldMap("t")])
+    assert rows == [(datetime(2022, 1, 1, 10, 30),), (None,)]
+    assert type(rows[0][0]) is datetime